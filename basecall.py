@@ -22,19 +22,33 @@ import argparse
 import collections
 import datetime
 import dateutil.parser
+import functools
 import h5py
+import io
+import numpy as np
 import os
+import pandas as pd
 import pathlib
-import random
+import queue
 import re
 import shutil
-import statistics
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 import uuid
 
+try:
+    import curses
+except ImportError:
+    curses = None
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
 
 BASECALLING = collections.OrderedDict([
     ('r9.4_fast', ['--config', 'dna_r9.4.1_450bps_fast.cfg']),
@@ -57,6 +71,28 @@ BARCODING = collections.OrderedDict([
     ('none',         [])
 ])
 
+# The sequencing_summary.txt columns used for the summaries (and their types).
+SUMMARY_COLUMNS = collections.OrderedDict([
+    ('run_id',                   'category'),
+    ('start_time',               np.float64),
+    ('duration',                 np.float64),
+    ('sequence_length_template', np.int64),
+    ('mean_qscore_template',     np.float64),
+    ('barcode_arrangement',      'category')
+])
+
+BARCODE_REGEX = re.compile(r'barcode\d\d')
+
+# How often (in seconds) to look for new fast5s when there aren't any waiting to be basecalled.
+TICK_SECONDS = 10
+
+# A fast5 seen by the watcher, along with its stat info (taken once, when it was found).
+Fast5Entry = collections.namedtuple('Fast5Entry', ['path', 'size', 'mtime', 'name'])
+
+# A batch of fast5s which has been linked into a temp directory for Guppy.
+Batch = collections.namedtuple('Batch', ['fast5s', 'all_fast5s', 'temp_dir', 'temp_in',
+                                         'temp_out'])
+
 
 def get_arguments():
     parser = MyParser(description='Basecall reads in real-time with Guppy',
@@ -75,7 +111,10 @@ def get_arguments():
 
     options = parser.add_argument_group('Options')
     options.add_argument('--batch_size', type=int, required=False, default=10,
-                         help='Number of fast5 files to basecall per batch')
+                         help='Maximum number of fast5 files to basecall per batch')
+    options.add_argument('--batch_bytes', type=int, required=False, default=2 ** 31,
+                         help='Stop adding fast5 files to a batch once their total size reaches '
+                              'this many bytes')
     options.add_argument('--stop_time', type=int, required=False, default=60,
                          help="Automatically stop when a new fast5 file hasn't been seen for this "
                               "many minutes")
@@ -85,6 +124,9 @@ def get_arguments():
                          help='Minimum score for a barcode to be detected in the middle of a read (default = 40)')
     options.add_argument('--cpu', action='store_true',
                          help='Use the CPU for basecalling (default: use the GPU)')
+    options.add_argument('--no_server', action='store_true',
+                         help="Run a fresh guppy_basecaller for each batch (default: keep the "
+                              "model loaded in a guppy_basecall_server for the whole run)")
     options.add_argument('--trans_window', type=int, required=False, default=60,
                          help='The time window size (in minutes) for the translocation speed '
                               'summary')
@@ -101,29 +143,223 @@ def main():
     args = get_arguments()
     check_guppy_version()
     make_output_directory(args.out_dir)
+    watcher = Fast5Watcher(args.in_dir)
+    already_basecalled = load_already_basecalled(args.out_dir)
+    already_basecalled_file = open_already_basecalled(args.out_dir)
+    server, server_address = None, None
+
+    staged_batches, basecalled_batches = queue.Queue(maxsize=1), queue.Queue(maxsize=1)
+    merged_batches = queue.Queue()
+    output_lock, stop, batch_wanted = threading.Lock(), threading.Event(), threading.Event()
+    stager = PipelineThread(stage_batches, watcher, args.batch_size, args.batch_bytes,
+                            already_basecalled, staged_batches, batch_wanted, stop)
+    merger = PipelineThread(merge_batches, basecalled_batches, args.out_dir, args.barcodes,
+                            args.trans_window, already_basecalled_file, output_lock,
+                            merged_batches)
+    unmerged_batch, merges_pending = None, 0
 
     try:
+        if not args.no_server:
+            server, server_address = start_basecall_server(args.model, args.cpu, args.out_dir)
+        stager.start()
+        merger.start()
         minutes_since_last_read, waiting = 0.0, False
         while True:
             if minutes_since_last_read >= args.stop_time:
                 print_stop_message(args.stop_time)
                 break
 
-            new_fast5s, all_fast5s = check_for_reads(args.batch_size, args.in_dir, args.out_dir)
-            if new_fast5s:
-                basecall_reads(new_fast5s, args.barcodes, args.model, args.detect_mid_strand_barcodes, args.min_score_mid_barcodes, args.cpu, args.out_dir)
-                summary_info(args.out_dir, args.barcodes, all_fast5s, args.trans_window)
-                minutes_since_last_read, waiting = 0.0, False
-
-            else:  # no new reads
-                print_waiting_message(waiting)
+            batch_wanted.set()
+            batch = get_staged_batch(staged_batches, stager)
+            if batch is None:  # no new reads
+                merges_pending = wait_for_merging(merged_batches, merges_pending, merger)
+                with output_lock:
+                    print_waiting_message(waiting)
                 waiting = True
-                tick_seconds = 10
-                minutes_since_last_read += tick_seconds / 60
-                time.sleep(tick_seconds)
+                minutes_since_last_read += TICK_SECONDS / 60
+                continue
+
+            try:
+                basecall_reads(batch, args.barcodes, args.model, args.detect_mid_strand_barcodes, args.min_score_mid_barcodes, args.cpu, server_address, output_lock)
+            except BaseException:
+                discard_batch(batch, already_basecalled)
+                raise
+            unmerged_batch = batch
+            put_batch(basecalled_batches, batch, merger)
+            unmerged_batch = None
+            merges_pending += 1
+            minutes_since_last_read, waiting = 0.0, False
+
+        finish_merging(basecalled_batches, merger, None)
+        merger.check()
 
     except KeyboardInterrupt:
         print()
+    finally:
+        # Even when quitting early, batches which Guppy has finished still get merged and
+        # recorded as basecalled, so they aren't basecalled again (and duplicated) next time.
+        stop.set()
+        if stager.is_alive():
+            stager.join()
+        discard_staged_batches(staged_batches, already_basecalled)
+        finish_merging(basecalled_batches, merger, unmerged_batch)
+        stop_basecall_server(server)
+        watcher.close()
+        already_basecalled_file.close()
+
+
+class PipelineThread(threading.Thread):
+    """
+    This class runs one stage of the basecalling pipeline on a daemon thread. Finding/staging new
+    reads and merging/summarising finished reads each get a thread, so they can happen while Guppy
+    is basecalling (on the main thread). If a stage fails, its exception is kept so the main
+    thread can raise it.
+    """
+    def __init__(self, stage_function, *stage_args):
+        super().__init__(daemon=True)
+        self.stage_function = stage_function
+        self.stage_args = stage_args
+        self.exception = None
+
+    def run(self):
+        try:
+            self.stage_function(*self.stage_args)
+        except BaseException as e:
+            self.exception = e
+
+    def check(self):
+        if self.exception is not None:
+            raise self.exception
+
+
+def stage_batches(watcher, batch_size, batch_bytes, already_basecalled, staged_batches,
+                  batch_wanted, stop):
+    """
+    Stages batches of new fast5s for the main thread. A batch isn't made until the main thread
+    wants one, so reads which arrive while Guppy is running are gathered into a full batch. When
+    a batch is wanted but there are no new reads, None is passed along instead (once per tick).
+    """
+    while not stop.is_set():
+        if not batch_wanted.wait(timeout=1):
+            continue
+        new_fast5s = check_for_reads(watcher, batch_size, batch_bytes, already_basecalled)
+        if new_fast5s:
+            batch_wanted.clear()
+            batch = stage_batch(new_fast5s, watcher)
+        else:
+            batch = None
+        while True:
+            if stop.is_set():
+                if batch is not None:
+                    discard_batch(batch, already_basecalled)
+                return
+            try:
+                staged_batches.put(batch, timeout=1)
+                break
+            except queue.Full:
+                pass
+        if batch is None:
+            stop.wait(TICK_SECONDS)
+
+
+def stage_batch(new_fast5s, watcher):
+    temp_dir = tempfile.TemporaryDirectory()
+    temp_in = pathlib.Path(temp_dir.name) / 'in'
+    temp_out = pathlib.Path(temp_dir.name) / 'out'
+    copy_reads_to_temp_in(new_fast5s, temp_in)
+    all_fast5s = list(watcher.all_fast5s)  # for looking up run start times
+    return Batch(new_fast5s, all_fast5s, temp_dir, temp_in, temp_out)
+
+
+def merge_batches(basecalled_batches, out_dir, barcodes, trans_window, already_basecalled_file,
+                  output_lock, merged_batches):
+    while True:
+        batch = basecalled_batches.get()
+        if batch is None:
+            return
+        try:
+            merge_results(batch.temp_out, out_dir, barcodes)
+        finally:
+            batch.temp_dir.cleanup()
+        add_to_already_basecalled(batch.fast5s, already_basecalled_file)
+
+        # The summaries are worked out without holding the output lock (which would hold up
+        # Guppy's output) and then printed in one go.
+        summary = io.StringIO()
+        summary_info(out_dir, barcodes, batch.all_fast5s, trans_window, summary)
+        with output_lock:
+            sys.stdout.write(summary.getvalue())
+            sys.stdout.flush()
+        merged_batches.put(batch)
+
+
+def put_batch(basecalled_batches, batch, merger):
+    while True:
+        merger.check()
+        try:
+            basecalled_batches.put(batch, timeout=1)
+            return
+        except queue.Full:
+            pass
+
+
+def finish_merging(basecalled_batches, merger, unmerged_batch):
+    """
+    Hands over any basecalled batch not yet given to the merging thread, then tells that thread
+    to stop and waits for it to finish.
+    """
+    if not merger.is_alive():
+        return
+    if unmerged_batch is not None:
+        put_batch(basecalled_batches, unmerged_batch, merger)
+    put_batch(basecalled_batches, None, merger)
+    merger.join()
+
+
+def discard_staged_batches(staged_batches, already_basecalled):
+    while True:
+        try:
+            batch = staged_batches.get_nowait()
+        except queue.Empty:
+            return
+        if batch is not None:
+            discard_batch(batch, already_basecalled)
+
+
+def discard_batch(batch, already_basecalled):
+    """
+    Deletes the temp directory of a batch which won't be basecalled after all, and releases its
+    fast5 names (claimed by pop_batch) so they can be basecalled next time.
+    """
+    batch.temp_dir.cleanup()
+    for fast5 in batch.fast5s:
+        already_basecalled.discard(fast5.name)
+
+
+def get_staged_batch(staged_batches, stager):
+    while True:
+        stager.check()
+        try:
+            return staged_batches.get(timeout=1)
+        except queue.Empty:
+            pass
+
+
+def wait_for_merging(merged_batches, merges_pending, merger):
+    """
+    Waits until all basecalled batches have been merged (and their summaries shown), checking
+    that the merging thread hasn't failed. The merging thread puts each batch it finishes on the
+    merged queue, so this just needs to collect the number still pending. Returns the number now
+    pending (i.e. zero).
+    """
+    while merges_pending:
+        merger.check()
+        try:
+            merged_batches.get(timeout=1)
+            merges_pending -= 1
+        except queue.Empty:
+            pass
+    return merges_pending
 
 
 def check_arguments(args):
@@ -146,15 +382,143 @@ def check_arguments(args):
     if args.batch_size <= 0:
         sys.exit('Error: --batch_size must be a positive integer')
 
+    if args.batch_bytes <= 0:
+        sys.exit('Error: --batch_bytes must be a positive integer')
+
     if args.out_dir.is_file():
         sys.exit('Error: {} is a file (must be a directory)'.format(args.out_dir))
 
 
-def check_for_reads(batch_size, in_dir, out_dir):
-    all_fast5_files = [x.resolve() for x in in_dir.glob('**/*.fast5')]
-    already_basecalled = load_already_basecalled(out_dir)
-    new_fast5_files = [f for f in all_fast5_files if f.name not in already_basecalled]
-    return sorted(f for f in new_fast5_files)[:batch_size], all_fast5_files
+def check_for_reads(watcher, batch_size, batch_bytes, already_basecalled):
+    return watcher.pop_batch(batch_size, batch_bytes, already_basecalled)
+
+
+class Fast5Watcher(object):
+    """
+    This class keeps track of the fast5 files in the input directory. When inotify is available,
+    the directory tree is only walked once (at startup) and new fast5s are then picked up from
+    filesystem events. Otherwise, it falls back to walking the whole directory on each check.
+    Each fast5 is stat-ed when it's found and the result is kept (as a Fast5Entry) so nothing
+    later on needs to stat it again.
+    """
+    def __init__(self, in_dir):
+        self.in_dir = in_dir.resolve()
+        self.all_fast5s = {}  # path -> Fast5Entry
+        self.pending = collections.deque()
+        self.watched_dirs = {}
+        self.inotify = None
+        if inotify_simple is not None:
+            try:
+                self.inotify = inotify_simple.INotify()
+                self.watch_directory(self.in_dir)
+            except OSError:
+                print('WARNING: could not watch {} with inotify - falling back to '
+                      'polling'.format(self.in_dir))
+                self.close()
+
+    def watch_directory(self, directory):
+        """
+        Adds an inotify watch to the directory and its subdirectories. The watch is added before
+        the directory is listed, so files created in the meantime aren't missed.
+        """
+        flags = inotify_simple.flags
+        wd = self.inotify.add_watch(str(directory),
+                                    flags.CREATE | flags.MOVED_TO | flags.CLOSE_WRITE)
+        self.watched_dirs[wd] = directory
+        subdirs, fast5s = [], []
+        for entry in os.scandir(str(directory)):
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(directory / entry.name)
+            elif entry.name.endswith('.fast5'):
+                fast5s.append(directory / entry.name)
+        for fast5 in sorted(fast5s):
+            self.add_fast5(fast5)
+        for subdir in sorted(subdirs):
+            self.watch_directory(subdir)
+
+    def add_fast5(self, fast5, restat=False):
+        """
+        Records a fast5 (and queues it for basecalling) if it hasn't been seen before. If restat
+        is True (the file was just written), a fast5 that's already known gets its stat info
+        updated.
+        """
+        is_new = fast5 not in self.all_fast5s
+        if not is_new and not restat:
+            return
+        try:
+            stat = os.stat(str(fast5))
+        except OSError:  # fast5 has already disappeared
+            return
+        self.all_fast5s[fast5] = Fast5Entry(fast5, stat.st_size, stat.st_mtime, fast5.name)
+        if is_new:
+            self.pending.append(fast5)
+
+    def update(self):
+        if self.inotify is None:
+            for fast5 in sorted(walk_fast5s(self.in_dir)):
+                self.add_fast5(fast5)
+            return
+        flags = inotify_simple.flags
+        try:
+            for event in self.inotify.read(timeout=0):
+                if event.mask & flags.Q_OVERFLOW:  # events were lost, so start over
+                    self.close()
+                    self.inotify = inotify_simple.INotify()
+                    self.watch_directory(self.in_dir)
+                    return
+                directory = self.watched_dirs.get(event.wd)
+                if directory is None or not event.name:
+                    continue
+                path = directory / event.name
+                if event.mask & flags.ISDIR:
+                    if event.mask & (flags.CREATE | flags.MOVED_TO):
+                        self.watch_directory(path)
+                elif event.mask & (flags.CLOSE_WRITE | flags.MOVED_TO):
+                    if path.suffix == '.fast5':
+                        self.add_fast5(path, restat=True)
+        except OSError:
+            print('WARNING: inotify failed - falling back to polling')
+            self.close()
+            self.update()
+
+    def pop_batch(self, batch_size, batch_bytes, already_basecalled):
+        """
+        Returns the next batch of fast5s to basecall. Files are added until there are batch_size
+        of them or their total size reaches batch_bytes. The batch's names are added to the
+        already-basecalled set straight away, so a same-named fast5 found while this batch is
+        still being basecalled won't be put in a later batch.
+        """
+        self.update()
+        batch, total_bytes = [], 0
+        while self.pending and len(batch) < batch_size and total_bytes < batch_bytes:
+            fast5 = self.all_fast5s[self.pending.popleft()]
+            if fast5.name not in already_basecalled:
+                batch.append(fast5)
+                total_bytes += fast5.size
+        already_basecalled.update(fast5.name for fast5 in batch)
+        return batch
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
+        self.watched_dirs = {}
+
+
+def walk_fast5s(in_dir):
+    """
+    Yields all fast5s in the directory (recursively). This uses os.scandir instead of globbing,
+    because the file types come with the directory listing and so no extra stat calls are needed.
+    The directory listings are read into lists (rather than using os.scandir as a context manager,
+    which needs Python 3.6) so each one is closed straight away.
+    """
+    directories = [str(in_dir)]
+    while directories:
+        for entry in list(os.scandir(directories.pop())):
+            if entry.is_dir(follow_symlinks=False):
+                directories.append(entry.path)
+            elif entry.name.endswith('.fast5'):
+                yield pathlib.Path(entry.path)
 
 
 def load_already_basecalled(out_dir):
@@ -167,12 +531,22 @@ def load_already_basecalled(out_dir):
     return already_basecalled_files
 
 
-def add_to_already_basecalled(fast5s, out_dir):
+def open_already_basecalled(out_dir):
+    """
+    The already-basecalled file is opened once (line buffered) and kept open for the whole run, so
+    each batch just appends to it.
+    """
     already_basecalled_filename = out_dir / 'basecalled_filenames'
-    with open(str(already_basecalled_filename), 'at') as already_basecalled:
-        for fast5 in fast5s:
-            already_basecalled.write(fast5.name)
-            already_basecalled.write('\n')
+    return open(str(already_basecalled_filename), 'at', buffering=1)
+
+
+def add_to_already_basecalled(fast5s, already_basecalled_file):
+    """
+    Records basecalled fast5s on disk. They're already in the in-memory set, having been added
+    when their batch was made.
+    """
+    for fast5 in fast5s:
+        already_basecalled_file.write(fast5.name + '\n')
 
 
 def print_basecalling_message():
@@ -193,81 +567,100 @@ def print_waiting_message(waiting):
         print('\n\nWaiting for new reads (Ctrl-C to quit)', end='', flush=True)
 
 
-def basecall_reads(new_fast5s, barcodes, model, detect_mid_strand_barcodes, min_score_mid_barcodes, cpu, out_dir):
-    print_basecalling_message()
-    with tempfile.TemporaryDirectory() as temp_dir:
-        temp_in = pathlib.Path(temp_dir) / 'in'
-        temp_out = pathlib.Path(temp_dir) / 'out'
-        copy_reads_to_temp_in(new_fast5s, temp_in)
-        guppy_command = get_guppy_command(temp_in, temp_out, barcodes, model, detect_mid_strand_barcodes, min_score_mid_barcodes, cpu)
-        execute_with_output(guppy_command)
-        merge_results(temp_out, out_dir, barcodes)
-    add_to_already_basecalled(new_fast5s, out_dir)
+def basecall_reads(batch, barcodes, model, detect_mid_strand_barcodes, min_score_mid_barcodes, cpu, server_address, output_lock):
+    with output_lock:
+        print_basecalling_message()
+        print_reads_to_be_basecalled(batch.fast5s)
+    guppy_command = get_guppy_command(batch.temp_in, batch.temp_out, barcodes, model, detect_mid_strand_barcodes, min_score_mid_barcodes, cpu, server_address)
+    execute_with_output(guppy_command, output_lock)
 
 
 def copy_reads_to_temp_in(new_fast5s, temp_in):
     temp_in.mkdir()
-    plural = '' if len(new_fast5s) == 1 else 's'
-    print('Read{} to be basecalled:'.format(plural))
+    names = set()
     for f in new_fast5s:
 
-        # Make sure that we aren't overwriting files in the temp directory. If so, give the new
-        # file a unique name.
-        new_path = temp_in / f.name
-        while new_path.is_file():
-            new_path = temp_in / (str(uuid.uuid4()) + '.fast5')
+        # Make sure that we aren't overwriting files in the temp directory (i.e. two fast5s in the
+        # batch have the same name). If so, give the new file a numbered name.
+        name, duplicate_count = f.name, 0
+        while name in names:
+            duplicate_count += 1
+            name = '{:06d}_{}'.format(duplicate_count, f.name)
+        names.add(name)
+
+        link_or_copy(f.path, temp_in / name)
 
-        shutil.copy(str(f), str(new_path))
-        print('    {}'.format(str(f)))
+
+def print_reads_to_be_basecalled(new_fast5s):
+    plural = '' if len(new_fast5s) == 1 else 's'
+    print('Read{} to be basecalled:'.format(plural))
+    for f in new_fast5s:
+        print('    {}'.format(str(f.path)))
     print()
 
 
-def summary_info(out_dir, barcodes, all_fast5s, trans_window):
-    translocation_speed_summary(out_dir, all_fast5s, trans_window)
-    if barcodes != 'none':
-        barcode_distribution_summary(out_dir, barcodes)
-    overall_summary(out_dir)
+def link_or_copy(source, destination):
+    """
+    Guppy only needs to be able to open the fast5s, so instead of copying them into the temp
+    directory, a hard link is made (or a symlink if the temp directory is on another filesystem).
+    The file is only copied if neither works.
+    """
+    try:
+        os.link(str(source), str(destination))
+        return
+    except OSError:
+        pass
+    try:
+        os.symlink(str(source.absolute()), str(destination))
+        return
+    except OSError:
+        pass
+    shutil.copy(str(source), str(destination))
 
 
-def translocation_speed_summary(out_dir, all_fast5s, time_window):
-    print('\n\n\n')
-    print('TRANSLOCATION SPEED')
-    print('------------------------------------------------------------')
-    data = read_sequencing_summary(out_dir, ['run_id', 'start_time', 'duration',
-                                             'sequence_length_template', 'mean_qscore_template'])
-    run_ids = set(x[0] for x in data)
-    run_start_times = {r: get_run_start_time(r, all_fast5s) for r in run_ids}
+def summary_info(out_dir, barcodes, all_fast5s, trans_window, output):
+    data = read_sequencing_summary(out_dir)
+    translocation_speed_summary(data, out_dir, all_fast5s, trans_window, output)
+    if barcodes != 'none':
+        barcode_distribution_summary(data, out_dir, barcodes, output)
+    overall_summary(data, output)
+
+
+def translocation_speed_summary(data, out_dir, all_fast5s, time_window, output):
+    print('\n\n\n', file=output)
+    print('TRANSLOCATION SPEED', file=output)
+    print('------------------------------------------------------------', file=output)
+    data = data[['run_id', 'start_time', 'duration', 'sequence_length_template',
+                 'mean_qscore_template']].copy()
+    run_start_times = {r: get_run_start_time(r, all_fast5s, output)
+                       for r in data['run_id'].unique()}
     earliest_start_time = min(run_start_times.values())
-    read_trans_speeds = []
-    max_time = 0.0
-    for run_id, start_time, duration, length, qscore in data:
-        start_time, duration, length, qscore = \
-            float(start_time), float(duration), int(length), float(qscore)
-        trans_speed = length / duration
-        read_time = (run_start_times[run_id] + datetime.timedelta(seconds=start_time) -
-                     earliest_start_time).total_seconds() / 60.0
-        max_time = max(max_time, read_time)
-        read_trans_speeds.append((read_time, trans_speed, qscore))
+    run_offsets = {r: (t - earliest_start_time).total_seconds()
+                   for r, t in run_start_times.items()}
+    data['trans_speed'] = data['sequence_length_template'] / data['duration']
+    data['read_time'] = \
+        (data['start_time'] + data['run_id'].map(run_offsets).astype(np.float64)) / 60.0
+    max_time = max(0.0, data['read_time'].max())
+    data['window'] = (data['read_time'] // time_window).astype(np.int64)
+    window_medians = data.groupby('window')[['trans_speed', 'mean_qscore_template']].median()
 
     with open(str(out_dir / 'translocation_speed.tsv'), 'wt') as trans_speed_file:
-        print('Time window     Speed    Qscore')
+        print('Time window     Speed    Qscore', file=output)
         trans_speed_file.write('minute_window_start\tminute_window_end\t'
                                'translocation_speed\tmean_qscore\n')
         window_start, window_end = 0, time_window
         while window_start < max_time:
-            window_data = [x for x in read_trans_speeds if window_start <= x[0] < window_end]
-            window_count = len(window_data)
-
-            if window_count > 0:
-                median_speed = statistics.median([x[1] for x in window_data])
+            window = window_start // time_window
+            if window in window_medians.index:
+                median_speed, median_qscore = window_medians.loc[window]
                 median_speed = '{:5.1f}'.format(median_speed)
-                median_qscore = statistics.median([x[2] for x in window_data])
                 median_qscore = '{:4.1f}'.format(median_qscore)
             else:
                 median_speed, median_qscore = '', ''
 
             print('{:4d} - {:4d}     {}      {}'.format(window_start, window_end,
-                                                        median_speed, median_qscore))
+                                                        median_speed, median_qscore),
+                  file=output)
             trans_speed_file.write('{}\t{}\t{}\t{}\n'.format(window_start, window_end,
                                                              median_speed, median_qscore))
             window_start += time_window
@@ -276,52 +669,89 @@ def translocation_speed_summary(out_dir, all_fast5s, time_window):
     # TODO: draw an ASCII plot showing the mean translocation speeds for time windows?
 
 
-def get_run_start_time(run_id, fast5s):
-    random.shuffle(fast5s)  # in case the ones we need are at the end
-    def get_run_id(_, node):
-        try:
-            return node.attrs['run_id'].decode()
-        except (AttributeError, KeyError):
-            pass
+# Run start times (keyed by run ID) and the fast5s which have already been checked for them, so
+# each fast5 is opened at most once over the whole run.
+run_start_times_cache = {}
+fast5s_checked_for_start_time = set()
 
-    def get_exp_start_time(_, node):
-        try:
-            return node.attrs['exp_start_time'].decode()
-        except (AttributeError, KeyError):
-            pass
 
-    for fast5 in fast5s:
-        f = h5py.File(fast5, 'r')
-        fast5_run_id = f.visititems(get_run_id)
-        if run_id == fast5_run_id:
-            exp_start_time = f.visititems(get_exp_start_time)
-            return dateutil.parser.parse(exp_start_time)
-        f.close()
-
-    print('WARNING: could not find exp_start_time in fast5')
+def get_run_start_time(run_id, fast5s, output):
+    if run_id not in run_start_times_cache:
+        for fast5 in fast5s:
+            if fast5 in fast5s_checked_for_start_time:
+                continue
+            fast5s_checked_for_start_time.add(fast5)
+            fast5_run_id, exp_start_time = get_fast5_run_info(fast5)
+            if fast5_run_id is None or exp_start_time is None:
+                continue
+            if fast5_run_id not in run_start_times_cache:
+                run_start_times_cache[fast5_run_id] = dateutil.parser.parse(exp_start_time)
+            if fast5_run_id == run_id:
+                break
+
+    if run_id in run_start_times_cache:
+        return run_start_times_cache[run_id]
+    print('WARNING: could not find exp_start_time in fast5', file=output)
     return datetime.datetime.now()
 
 
-def barcode_distribution_summary(out_dir, barcode_kit):
-    print('\n\n\n')
-    print('BARCODE DISTRIBUTION')
-    print('------------------------------------------------------------')
-    barcode_data = read_sequencing_summary(out_dir, ['sequence_length_template',
-                                                     'barcode_arrangement'])
+def get_fast5_run_info(fast5):
+    """
+    Returns the run ID and experiment start time from a fast5's tracking_id attributes. These are
+    read directly from where they live in single-read fast5s (UniqueGlobalKey/tracking_id) and
+    multi-read fast5s (read_XXX/tracking_id), instead of walking the whole file.
+    """
+    try:
+        with open_fast5_for_attributes(fast5) as f:
+            tracking_paths = ['UniqueGlobalKey/tracking_id']
+            first_group = next(iter(f.keys()), None)
+            if first_group is not None:
+                tracking_paths.append(first_group + '/tracking_id')
+            for tracking_path in tracking_paths:
+                if tracking_path in f:
+                    attrs = f[tracking_path].attrs
+                    return get_str_attr(attrs, 'run_id'), get_str_attr(attrs, 'exp_start_time')
+    except OSError:  # fast5 is missing or still being written
+        pass
+    return None, None
+
+
+def open_fast5_for_attributes(fast5):
+    """
+    Opens a fast5 read-only for looking at attributes. The raw data chunk cache is turned off
+    (since no datasets are read), and SWMR read mode is used so we can cleanly read files that
+    MinKNOW may still be writing. If the file can't be opened in SWMR mode, it's opened normally.
+    """
+    fapl = h5py.h5p.create(h5py.h5p.FILE_ACCESS)
+    fapl.set_cache(0, 1, 0, 0.75)
+    filename = str(fast5).encode()
+    try:
+        fid = h5py.h5f.open(filename, h5py.h5f.ACC_RDONLY | h5py.h5f.ACC_SWMR_READ, fapl=fapl)
+    except (OSError, ValueError):
+        fid = h5py.h5f.open(filename, h5py.h5f.ACC_RDONLY, fapl=fapl)
+    return h5py.File(fid)
+
+
+def get_str_attr(attrs, name):
+    try:
+        value = attrs[name]
+    except KeyError:
+        return None
+    if isinstance(value, bytes):
+        value = value.decode()
+    return str(value)
+
+
+def barcode_distribution_summary(data, out_dir, barcode_kit, output):
+    print('\n\n\n', file=output)
+    print('BARCODE DISTRIBUTION', file=output)
+    print('------------------------------------------------------------', file=output)
     first_barcode = int(barcode_kit.split('_')[-1].split('-')[0])
     last_barcode = int(barcode_kit.split('_')[-1].split('-')[1])
     barcode_names = ['barcode{:02}'.format(i) for i in range(first_barcode, last_barcode + 1)]
     barcode_names.append('unclassified')
-    bases = {name: 0 for name in barcode_names}
-    reads = {name: 0 for name in barcode_names}
-    for length, name in barcode_data:
-        length = int(length)
-        bases[name] += length
-        reads[name] += 1
+    bases, reads, n50s = get_barcode_stats(data, barcode_names)
     overall_total = sum(bases.values())
-    n50s = {}
-    for name in barcode_names:
-        n50s[name] = get_n50([int(x[0]) for x in barcode_data if x[1] == name])
 
     max_total_len = max(len('{:,}'.format(t)) for t in bases.values())
     total_format_str = '{:' + str(max_total_len) + ',} bp'
@@ -335,61 +765,114 @@ def barcode_distribution_summary(out_dir, barcode_kit):
             row += ' {:.2f}%'.format(bases_percent).rjust(9)
             if n50s[name]:
                 row += '   N50 = {:6,} bp'.format(n50s[name])
-            print(row)
+            print(row, file=output)
             barcode_file.write('{}\t{}\t{}\t{:.2f}\t{}\n'.format(name, reads[name], bases[name],
                                                                  bases_percent, n50s[name]))
-    print()
+    print(file=output)
 
     # TODO: for each barcode, draw an ASCII bar plot for the number of bases and the N50 read size?
 
 
-def overall_summary(out_dir):
-    print('\n\n\n')
-    print('TOTALS')
-    print('------------------------------------------------------------')
-    sequence_lengths = read_sequencing_summary(out_dir, ['sequence_length_template'])
-    sequence_lengths = [int(x[0]) for x in sequence_lengths]
+def get_barcode_stats(data, barcode_names):
+    """
+    Returns the total bases, read count and N50 for each barcode. The reads are sorted by length
+    once and all three values come from a single groupby, so each N50 is the first (longest-first)
+    read where its barcode's running total reaches half of that barcode's bases.
+    """
+    barcode_data = pd.DataFrame({'barcode': data['barcode_arrangement'].astype(str),
+                                 'length': data['sequence_length_template']})
+    barcode_data = barcode_data.sort_values('length', ascending=False, kind='stable')
+    grouped = barcode_data.groupby('barcode')['length']
+    totals = grouped.sum()
+    half_totals = barcode_data['barcode'].map(totals) * 0.5
+    past_half = barcode_data[grouped.cumsum() >= half_totals]
+    n50s = past_half.groupby('barcode')['length'].first()
+
+    def to_dict(series):
+        series = series.reindex(barcode_names, fill_value=0)
+        return {name: int(value) for name, value in series.items()}
+    return to_dict(totals), to_dict(grouped.count()), to_dict(n50s)
+
+
+def overall_summary(data, output):
+    print('\n\n\n', file=output)
+    print('TOTALS', file=output)
+    print('------------------------------------------------------------', file=output)
+    sequence_lengths = data['sequence_length_template'].values
     num_reads = len(sequence_lengths)
-    total_bases = sum(sequence_lengths)
+    total_bases = int(sequence_lengths.sum())
     n50 = get_n50(sequence_lengths)
-    print('Number of reads: {:14,}'.format(num_reads))
-    print('Total bases:     {:14,}'.format(total_bases))
-    print('Read N50:        {:14,}'.format(n50))
-    print()
+    print('Number of reads: {:14,}'.format(num_reads), file=output)
+    print('Total bases:     {:14,}'.format(total_bases), file=output)
+    print('Read N50:        {:14,}'.format(n50), file=output)
+    print(file=output)
 
 
 def get_n50(sequence_lengths):
-    sequence_lengths = sorted(sequence_lengths, reverse=True)
-    total_bases = sum(sequence_lengths)
-    target_bases = total_bases * 0.5
-    bases_so_far = 0
-    for sequence_length in sequence_lengths:
-        bases_so_far += sequence_length
-        if bases_so_far >= target_bases:
-            return sequence_length
-    return 0
-
-
-def read_sequencing_summary(out_dir, columns):
-    summary_filename = str(out_dir / 'sequencing_summary.txt')
-    with open(summary_filename, 'rt') as summary:
-        headers = summary.readline().strip().split('\t')
-    column_numbers = [headers.index(x) for x in columns]
-    data = []
-    with open(summary_filename, 'rt') as summary:
-        for line in summary:
-            if line.startswith('filename'):
-                continue
-            parts = line.strip().split('\t')
-            data.append([parts[i] for i in column_numbers])
-    return data
+    sequence_lengths = np.sort(np.asarray(sequence_lengths, dtype=np.int64))[::-1]
+    if len(sequence_lengths) == 0:
+        return 0
+    bases_so_far = np.cumsum(sequence_lengths)
+    i = np.searchsorted(bases_so_far, bases_so_far[-1] * 0.5)
+    return int(sequence_lengths[min(i, len(sequence_lengths) - 1)])
+
+
+# The rows of sequencing_summary.txt loaded so far and the byte offset they go up to. Since the
+# file only grows (batches are appended to it), each summary just needs to parse the new rows.
+# The file's headers (and which of them are needed) are also worked out once and kept.
+summary_cache = {'offset': 0, 'headers': None, 'columns': None, 'data': None}
 
 
-def get_guppy_command(in_dir, out_dir, barcodes, model, detect_mid_strand_barcodes, min_score_mid_barcodes, cpu):
+def read_sequencing_summary(out_dir):
+    """
+    Loads the columns needed for the summaries from sequencing_summary.txt, so the summary
+    functions can share one DataFrame. Only rows appended since the last call are parsed. If the
+    file has shrunk (i.e. it was replaced), it is loaded again from the start.
+    """
+    summary_filename = out_dir / 'sequencing_summary.txt'
+    if summary_filename.stat().st_size < summary_cache['offset']:
+        summary_cache.update(offset=0, headers=None, columns=None, data=None)
+    with open(str(summary_filename), 'rb') as summary:
+        summary.seek(summary_cache['offset'])
+        if summary_cache['headers'] is None:
+            headers = summary.readline().decode().rstrip('\r\n').split('\t')
+            summary_cache['headers'] = headers
+            summary_cache['columns'] = [h for h in headers if h in SUMMARY_COLUMNS]
+        start = summary.tell()
+        new_rows = summary.read()
+    new_rows = new_rows[:new_rows.rfind(b'\n') + 1]  # leave any partly-written line for later
+    summary_cache['offset'] = start + len(new_rows)
+    new_data = pd.read_csv(io.BytesIO(new_rows), sep='\t', header=None,
+                           names=summary_cache['headers'],
+                           usecols=summary_cache['columns'], dtype=SUMMARY_COLUMNS)
+    summary_cache['data'] = append_summary_data(summary_cache['data'], new_data)
+    return summary_cache['data']
+
+
+def append_summary_data(data, new_data):
+    """
+    Adds newly-read summary rows to the existing ones. Categorical columns are combined with
+    union_categoricals, because concatenating categoricals with different categories would turn
+    them into plain object columns.
+    """
+    if data is None or data.empty:
+        return new_data
+    if new_data.empty:
+        return data
+    combined = pd.concat([data, new_data], ignore_index=True)
+    for column, dtype in SUMMARY_COLUMNS.items():
+        if dtype == 'category' and column in combined:
+            combined[column] = pd.api.types.union_categoricals([data[column], new_data[column]])
+    return combined
+
+
+def get_guppy_command(in_dir, out_dir, barcodes, model, detect_mid_strand_barcodes, min_score_mid_barcodes, cpu, server_address):
     guppy_command = ['guppy_basecaller',
                      '--input_path', str(in_dir),
                      '--save_path', str(out_dir)]
-    if not cpu:
+    if server_address is not None:
+        guppy_command += ['--port', server_address]
+    elif not cpu:
         guppy_command += ['--device', 'auto']
     if detect_mid_strand_barcodes:
         guppy_command += ['--detect_mid_strand_barcodes']
@@ -399,6 +882,56 @@ def get_guppy_command(in_dir, out_dir, barcodes, model, detect_mid_strand_barcod
     return guppy_command
 
 
+def start_basecall_server(model, cpu, out_dir):
+    """
+    Starts a guppy_basecall_server which stays up for the whole run, so the model is only loaded
+    (and the GPU initialised) once. Each batch is then run with guppy_basecaller in client mode
+    (--port), which gives the same fastq and sequencing_summary.txt output as before. If the
+    server isn't installed or doesn't start, this returns None and each batch will run standalone.
+    """
+    if shutil.which('guppy_basecall_server') is None:
+        return None, None
+    server_address = 'ipc:///tmp/guppy-{}'.format(uuid.uuid4())
+    server_command = ['guppy_basecall_server',
+                      '--port', server_address,
+                      '--log_path', str(out_dir / 'guppy_logs')]
+    if not cpu:
+        server_command += ['--device', 'auto']
+    server_command += BASECALLING[model]
+    print('\n\nSTARTING GUPPY BASECALL SERVER')
+    print('------------------------------------------------------------')
+    print_formatted_guppy_command(server_command)
+
+    server_output_filename = out_dir / 'guppy_logs' / 'guppy_basecall_server.out'
+    with open(str(server_output_filename), 'wb') as server_output:
+        server = subprocess.Popen(server_command, stdout=server_output,
+                                  stderr=subprocess.STDOUT)
+    for _ in range(120):
+        if server.poll() is not None:
+            break
+        with open(str(server_output_filename), 'rb') as server_output:
+            if b'Starting server' in server_output.read():
+                print('Server is running\n')
+                return server, server_address
+        time.sleep(1)
+
+    print('WARNING: guppy_basecall_server failed to start (see {}) - running guppy_basecaller '
+          'separately for each batch instead'.format(server_output_filename))
+    stop_basecall_server(server)
+    return None, None
+
+
+def stop_basecall_server(server):
+    if server is None or server.poll() is not None:
+        return
+    server.terminate()
+    try:
+        server.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        server.kill()
+        server.wait()
+
+
 def check_python_version():
     try:
         assert sys.version_info >= (3, 5)
@@ -448,7 +981,7 @@ class MyHelpFormatter(argparse.HelpFormatter):
         terminal_width = shutil.get_terminal_size().columns
         os.environ['COLUMNS'] = str(terminal_width)
         max_help_position = min(max(24, terminal_width // 3), 40)
-        self.colours = get_colours_from_tput()
+        self.colours = get_colours_from_terminfo()
         super().__init__(prog, max_help_position=max_help_position)
 
     def _get_help_string(self, action):
@@ -512,26 +1045,43 @@ class MyHelpFormatter(argparse.HelpFormatter):
         return self._join_parts(parts)
 
 
-def get_colours_from_tput():
+@functools.lru_cache(maxsize=None)
+def get_colours_from_terminfo():
+    """
+    Gets the terminal's number of colours from terminfo (what 'tput colors' reports) without
+    running a subprocess. argparse makes a new help formatter a few times, so it's cached too.
+    """
+    if curses is None:
+        return 1
     try:
-        return int(subprocess.check_output(['tput', 'colors']).decode().strip())
-    except (ValueError, subprocess.CalledProcessError, FileNotFoundError, AttributeError):
+        curses.setupterm()
+        colours = curses.tigetnum('colors')
+    except (curses.error, OSError, ValueError, AttributeError):
         return 1
+    return colours if colours > 0 else 1
 
 
-def execute_with_output(cmd):
+def execute_with_output(cmd, output_lock):
     """
-    Run a command and display its output.
+    Run a command and display its output. The output lock is held for each chunk of output, so
+    it doesn't get mixed up with summaries being printed from the merging thread.
     https://stackoverflow.com/a/4417735/2438989
     """
-    print_formatted_guppy_command(cmd)
-    print()
+    with output_lock:
+        print_formatted_guppy_command(cmd)
+        print()
+        sys.stdout.flush()
     p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    for c in iter(lambda: p.stdout.read(1), b''):
-        print(c.decode(), end='', flush=True)
+    # read1 returns whatever output is available (up to 128 KiB) without waiting for a full buffer
+    # or a newline, so Guppy's progress bar still shows up as it goes.
+    for chunk in iter(lambda: p.stdout.read1(131072), b''):
+        with output_lock:
+            sys.stdout.buffer.write(chunk)
+            sys.stdout.buffer.flush()
     p.stdout.close()
     return_code = p.wait()
-    print()
+    with output_lock:
+        print()
     if return_code:
         raise subprocess.CalledProcessError(return_code, cmd)
 
@@ -539,6 +1089,7 @@ def execute_with_output(cmd):
 def print_formatted_guppy_command(cmd):
     cmd = ' '.join(cmd)
     cmd = cmd.replace('--save_path', '\\\n                 --save_path')
+    cmd = cmd.replace('--port', '\\\n                 --port')
     cmd = cmd.replace('--config', '\\\n                 --config')
     cmd = cmd.replace('--model', '\\\n                 --model')
     cmd = cmd.replace('--barcode_kits', '\\\n                 --barcode_kits')
@@ -571,29 +1122,85 @@ def get_destination_filename(barcodes, out_dir, source_filename):
     if barcodes == 'none':
         return str(out_dir / 'reads.fastq')
     else:
-        match = re.search(r'barcode\d\d', str(source_filename))
-        if match:
-            barcode = match.group(0)
-        else:
-            barcode = 'unclassified'
+        # Guppy puts barcoded reads in a barcodeXX directory, so check that before searching the
+        # whole path.
+        barcode = source_filename.parent.name
+        if not BARCODE_REGEX.fullmatch(barcode):
+            match = BARCODE_REGEX.search(str(source_filename))
+            if match:
+                barcode = match.group(0)
+            else:
+                barcode = 'unclassified'
         return str(out_dir / (barcode + '.fastq'))
 
 
 def merge_fastq(source_filename, destination_filename):
-    with open(str(source_filename), 'rt') as source:
-        with open(str(destination_filename), 'at') as destination:
-            for line in source:
-                destination.write(line)
+    with open(str(source_filename), 'rb') as source:
+        with open_for_appending(destination_filename) as destination:
+            append_file_contents(source, destination)
 
 
 def merge_summary(source_filename, destination_filename):
     include_header = not destination_filename.is_file()
-    with open(str(source_filename), 'rt') as source:
-        with open(str(destination_filename), 'at') as destination:
-            for line in source:
-                if not include_header and line.startswith('filename'):
-                    continue
-                destination.write(line)
+    with open(str(source_filename), 'rb') as source:
+        with open_for_appending(destination_filename) as destination:
+            if not include_header:
+                first_line = source.readline()
+                if not first_line.startswith(b'filename'):
+                    destination.write(first_line)
+            append_file_contents(source, destination)
+
+
+def open_for_appending(filename):
+    """
+    Opens a file for writing at its end. This doesn't use 'ab' mode because the kernel copy calls
+    (copy_file_range and sendfile) refuse to write to a file opened with O_APPEND.
+    """
+    fd = os.open(str(filename), os.O_WRONLY | os.O_CREAT, 0o666)
+    destination = open(fd, 'wb')
+    destination.seek(0, os.SEEK_END)
+    return destination
+
+
+def append_file_contents(source, destination):
+    """
+    Copies the rest of the source file (from its current position) onto the end of the
+    destination. Where possible this is done in the kernel (copy_file_range, which can reflink on
+    filesystems that support it, or sendfile) so the data never passes through Python. If neither
+    is available or they fail, it falls back to shutil.copyfileobj.
+    """
+    destination.flush()
+    source_fd, destination_fd = source.fileno(), destination.fileno()
+    offset = source.tell()
+    size = os.fstat(source_fd).st_size
+    for kernel_copy in get_kernel_copy_functions():
+        try:
+            while offset < size:
+                copied = kernel_copy(source_fd, destination_fd, offset, size - offset)
+                if copied == 0:
+                    break
+                offset += copied
+        except OSError:
+            continue
+        if offset >= size:
+            return
+    source.seek(offset)
+    shutil.copyfileobj(source, destination, 1 << 20)
+
+
+def get_kernel_copy_functions():
+    """
+    Returns the available in-kernel file copy functions, all wrapped to take the same arguments:
+    (source_fd, destination_fd, source_offset, count).
+    """
+    kernel_copy_functions = []
+    if hasattr(os, 'copy_file_range'):
+        kernel_copy_functions.append(lambda s, d, offset, count:
+                                     os.copy_file_range(s, d, count, offset))
+    if hasattr(os, 'sendfile'):
+        kernel_copy_functions.append(lambda s, d, offset, count:
+                                     os.sendfile(d, s, offset, count))
+    return kernel_copy_functions
 
 
 def get_timestamp(log_filename):